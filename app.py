@@ -62,9 +62,11 @@ def pil_to_photoimage(pil_image):
     return tk.PhotoImage(data=bio.getvalue())
 
 class VideoPlayerFrame(ctk.CTkFrame):
-    def __init__(self, master, **kwargs):
+    def __init__(self, master, open_capture=cv2.VideoCapture, **kwargs):
         super().__init__(master, **kwargs)
         
+        # Opens a cv2.VideoCapture; lets the app apply its decoder threading settings
+        self.open_capture = open_capture
         self.video_path = None
         self.cap = None
         self.is_playing = False
@@ -91,7 +93,7 @@ class VideoPlayerFrame(ctk.CTkFrame):
             return
 
         # Open strictly for one frame
-        cap = cv2.VideoCapture(path)
+        cap = self.open_capture(path)
         if not cap.isOpened():
             self.display_label.configure(text="Error loading video")
             return
@@ -125,7 +127,7 @@ class VideoPlayerFrame(ctk.CTkFrame):
             
             # Initialize capture if needed
             if self.cap is None or not self.cap.isOpened():
-                self.cap = cv2.VideoCapture(self.video_path)
+                self.cap = self.open_capture(self.video_path)
                 
                 # Restore position from slider
                 total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -283,13 +285,20 @@ class App(ctk.CTk):
         self.add_btn = ctk.CTkButton(self.left_panel, text="Add Videos", command=self.add_videos)
         self.add_btn.grid(row=2, column=0, pady=10, padx=10, sticky="ew")
 
+        # Library suggestions for the clip that flows best after the last one
+        self.suggest_frame = ctk.CTkFrame(self.left_panel, fg_color="transparent")
+        self.suggest_frame.grid(row=3, column=0, pady=(0, 10), padx=10, sticky="ew")
+        self.suggest_label = ctk.CTkLabel(self.suggest_frame, text="", anchor="w")
+        self.suggest_label.pack(fill="x")
+        self.suggest_buttons = []
+
         # --- Right Column: Preview & Stitch ---
         self.right_panel = ctk.CTkFrame(self)
         self.right_panel.grid(row=0, column=1, sticky="nsew", padx=10, pady=10)
         self.right_panel.grid_rowconfigure(0, weight=1) 
         self.right_panel.grid_columnconfigure(0, weight=1)
 
-        self.player = VideoPlayerFrame(self.right_panel)
+        self.player = VideoPlayerFrame(self.right_panel, open_capture=self.stitcher.open_capture)
         self.player.grid(row=0, column=0, sticky="nsew", padx=10, pady=10)
 
         # Action Area
@@ -324,6 +333,12 @@ class App(ctk.CTk):
 
     def add_videos(self):
         files = filedialog.askopenfilenames(filetypes=[("Video Files", "*.mp4 *.mov *.avi *.mkv")])
+        if files:
+            self.add_video_paths(files)
+            # Index new footage in the background so it can be suggested later
+            threading.Thread(target=self.run_index_process, args=(list(files),), daemon=True).start()
+
+    def add_video_paths(self, files):
         if files:
             for f in files:
                 if f not in self.video_paths:
@@ -340,6 +355,49 @@ class App(ctk.CTk):
                         self.thumbnails[f] = None
             self.refresh_list()
 
+    def run_index_process(self, paths):
+        try:
+            self.stitcher.index_clips(paths)
+        except Exception as e:
+            print(f"Error indexing clips: {e}")
+        self.after(0, self.refresh_suggestions)
+
+    def refresh_suggestions(self):
+        for btn in self.suggest_buttons:
+            btn.destroy()
+        self.suggest_buttons.clear()
+        self.suggest_label.configure(text="")
+
+        if not self.video_paths:
+            return
+        last_path = self.video_paths[-1]
+        if not self.stitcher.is_indexed(last_path):
+            # Still being indexed; suggestions appear once indexing finishes
+            return
+
+        suggestions = self.stitcher.suggest_next_clips(last_path, k=5, exclude=self.video_paths)
+        # The library outlives the files it indexes
+        suggestions = [s for s in suggestions if os.path.exists(s[0])][:3]
+        if not suggestions:
+            return
+
+        self.suggest_label.configure(text="Suggested next:")
+        for path, score, _ in suggestions:
+            name = os.path.basename(path)
+            if len(name) > 30:
+                name = name[:20] + "..." + name[-7:]
+            btn = ctk.CTkButton(
+                self.suggest_frame,
+                text=f"+ {name}",
+                anchor="w",
+                height=24,
+                fg_color="transparent",
+                border_width=1,
+                command=lambda p=path: self.add_video_paths([p]),
+            )
+            btn.pack(fill="x", pady=1)
+            self.suggest_buttons.append(btn)
+
     def refresh_list(self):
         for w in self.scroll_frame.winfo_children():
             w.destroy()
@@ -358,6 +416,8 @@ class App(ctk.CTk):
             item.pack(fill="x", pady=2, padx=2)
             self.list_widgets.append(item)
 
+        self.refresh_suggestions()
+
     def on_drag_start(self, event, index):
         self.drag_data["index"] = index
         self.drag_data["item"] = self.list_widgets[index]
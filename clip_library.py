@@ -0,0 +1,251 @@
+import os
+
+import cv2
+import numpy as np
+
+from codec_settings import SETTINGS_DIR
+
+# Where the library index is persisted between sessions
+LIBRARY_PATH = os.path.join(SETTINGS_DIR, "library_index.npz")
+
+# Size (width, height) of the thumbnails stored per sampled frame. Small enough that
+# a brute-force query over tens of thousands of clips stays in the tens of milliseconds.
+EMBED_SIZE = (16, 9)
+
+
+def file_identity(path):
+    """
+    Returns (size, mtime in nanoseconds) for path, or None if it can't be read.
+    Used to tell whether a file changed since its embeddings or signature were taken.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def embed_window(features, roi=None):
+    """
+    Turns a window of feature frames (frames, height, width) into compact vectors,
+    one row per frame. Pixels outside the ROI mask are replaced with the mean of the
+    informative pixels and the frame is cropped to the ROI bounding box, so letterbox
+    bars and static overlays don't dominate the distance.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    if len(features) == 0:
+        return np.empty((0, EMBED_SIZE[0] * EMBED_SIZE[1]), dtype=np.float32)
+
+    if roi is not None and roi.shape == features.shape[1:] and roi.any():
+        rows = np.flatnonzero(roi.any(axis=1))
+        cols = np.flatnonzero(roi.any(axis=0))
+        ys = slice(rows[0], rows[-1] + 1)
+        xs = slice(cols[0], cols[-1] + 1)
+        features = features[:, ys, xs].copy()
+        mask = roi[ys, xs]
+        if not mask.all():
+            for frame in features:
+                frame[~mask] = frame[mask].mean()
+
+    vectors = [cv2.resize(frame, EMBED_SIZE, interpolation=cv2.INTER_AREA).ravel() for frame in features]
+    return np.array(vectors, dtype=np.float32)
+
+
+class ClipLibraryIndex:
+    """
+    Persistent index of head/tail embeddings for a library of clips.
+
+    Head vectors of all clips live in one contiguous matrix so a top-k "best next
+    clip" query is a single vectorized brute-force distance computation. Each clip's
+    rows are contiguous, which lets per-clip minima be taken with reduceat. Rows are
+    appended into a buffer with spare capacity, so inserting new footage is amortized
+    O(new frames).
+    """
+
+    def __init__(self):
+        dim = EMBED_SIZE[0] * EMBED_SIZE[1]
+        self.paths = []  # clip index -> file path
+        self.identities = []  # clip index -> file_identity() when indexed
+        self.tails = []  # clip index -> tail vectors used when querying from that clip
+        self._path_index = {}
+        self._offsets = []  # clip index -> first row in the head matrix
+        self._heads = np.empty((0, dim), dtype=np.float32)
+        self._head_norms = np.empty(0, dtype=np.float32)
+        self._head_times = np.empty(0, dtype=np.float32)
+        self._rows = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self._path_index
+
+    def is_current(self, path):
+        """Returns True if path is indexed and hasn't changed on disk since."""
+        index = self._path_index.get(path)
+        if index is None:
+            return False
+        identity = file_identity(path)
+        return identity is not None and identity == self.identities[index]
+
+    def add(self, path, head_vectors, head_times, tail_vectors, identity=None):
+        """
+        Inserts a clip, replacing any previous entry for the same path.
+        """
+        if path in self._path_index:
+            self.remove(path)
+        if identity is None:
+            identity = file_identity(path)
+
+        head_vectors = np.asarray(head_vectors, dtype=np.float32)
+        count = len(head_vectors)
+        self._reserve(self._rows + count)
+        rows = slice(self._rows, self._rows + count)
+        self._heads[rows] = head_vectors
+        self._head_norms[rows] = np.einsum("ij,ij->i", head_vectors, head_vectors)
+        self._head_times[rows] = head_times
+
+        self._path_index[path] = len(self.paths)
+        self.paths.append(path)
+        self.identities.append(identity)
+        self.tails.append(np.asarray(tail_vectors, dtype=np.float32))
+        self._offsets.append(self._rows)
+        self._rows += count
+
+    def remove(self, path):
+        """
+        Drops a clip from the index, compacting the head matrix.
+        """
+        index = self._path_index.get(path)
+        if index is None:
+            return
+        start = self._offsets[index]
+        end = self._offsets[index + 1] if index + 1 < len(self._offsets) else self._rows
+        count = end - start
+
+        for array in (self._heads, self._head_norms, self._head_times):
+            array[start:self._rows - count] = array[end:self._rows]
+        self._rows -= count
+
+        del self.paths[index], self.identities[index], self.tails[index], self._offsets[index]
+        self._offsets[index:] = [offset - count for offset in self._offsets[index:]]
+        self._path_index = {p: i for i, p in enumerate(self.paths)}
+
+    def _reserve(self, rows):
+        capacity = len(self._heads)
+        if rows <= capacity:
+            return
+        capacity = max(rows, 2 * capacity, 256)
+        heads = np.empty((capacity, self._heads.shape[1]), dtype=np.float32)
+        heads[:self._rows] = self._heads[:self._rows]
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[:self._rows] = self._head_norms[:self._rows]
+        times = np.empty(capacity, dtype=np.float32)
+        times[:self._rows] = self._head_times[:self._rows]
+        self._heads, self._head_norms, self._head_times = heads, norms, times
+
+    def query(self, tail_vectors, k=5, exclude=()):
+        """
+        Finds the clips whose head flows best after a clip with the given tail vectors.
+        Returns up to k (path, score, head_time) tuples, best first. The score is the
+        mean squared difference of the closest tail/head frame pair (lower is better)
+        and head_time is where that clip would start.
+        """
+        tail_vectors = np.asarray(tail_vectors, dtype=np.float32)
+        if len(tail_vectors) == 0 or self._rows == 0:
+            return []
+
+        heads = self._heads[:self._rows]
+        # Squared distances of every tail frame to every head frame: |q|^2 + |h|^2 - 2 q.h
+        tail_norms = np.einsum("ij,ij->i", tail_vectors, tail_vectors)
+        distances = tail_norms[:, None] + self._head_norms[:self._rows][None, :] - 2 * (tail_vectors @ heads.T)
+        best_rows = distances.min(axis=0)
+
+        offsets = np.array(self._offsets)
+        # Clips with no head frames would break reduceat; give them an infinite score
+        sizes = np.diff(np.append(offsets, self._rows))
+        clip_scores = np.full(len(self.paths), np.inf, dtype=np.float32)
+        non_empty = sizes > 0
+        clip_scores[non_empty] = np.minimum.reduceat(best_rows, offsets[non_empty])
+        clip_scores /= heads.shape[1]
+
+        for path in exclude:
+            index = self._path_index.get(path)
+            if index is not None:
+                clip_scores[index] = np.inf
+
+        candidates = np.flatnonzero(np.isfinite(clip_scores))
+        if len(candidates) == 0:
+            return []
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(clip_scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(clip_scores[top])]
+
+        results = []
+        for index in top:
+            start = self._offsets[index]
+            end = start + sizes[index]
+            row = start + int(np.argmin(best_rows[start:end]))
+            results.append((self.paths[index], max(0.0, float(clip_scores[index])), float(self._head_times[row])))
+        return results
+
+    def query_path(self, path, k=5, exclude=()):
+        """
+        Like query, using the stored tail of an indexed clip. The clip itself is excluded.
+        """
+        index = self._path_index.get(path)
+        if index is None:
+            return []
+        return self.query(self.tails[index], k=k, exclude=set(exclude) | {path})
+
+    def save(self, path=LIBRARY_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tail_counts = np.array([len(t) for t in self.tails], dtype=np.int64)
+        tails = np.concatenate(self.tails) if self.tails else np.empty((0, self._heads.shape[1]), dtype=np.float32)
+        # Write to a temporary file first so an interrupted save keeps the old index
+        partial_path = path + ".part.npz"
+        np.savez(
+            partial_path,
+            paths=np.array(self.paths, dtype=str),
+            identities=np.array([i or (-1, -1) for i in self.identities], dtype=np.int64).reshape(-1, 2),
+            offsets=np.array(self._offsets, dtype=np.int64),
+            heads=self._heads[:self._rows],
+            head_times=self._head_times[:self._rows],
+            tails=tails,
+            tail_counts=tail_counts,
+        )
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path=LIBRARY_PATH):
+        """
+        Loads a persisted index, returning an empty one if there is none or it can't be read.
+        """
+        index = cls()
+        try:
+            with np.load(path) as data:
+                paths = [str(p) for p in data["paths"]]
+                identities = [tuple(i) for i in data["identities"].tolist()]
+                offsets = data["offsets"].tolist()
+                heads = data["heads"]
+                head_times = data["head_times"]
+                tails = np.split(data["tails"], np.cumsum(data["tail_counts"])[:-1]) if len(paths) else []
+        except (OSError, ValueError, KeyError):
+            # Missing, unreadable or written by an older version; clips get re-indexed
+            return index
+
+        if heads.shape[1:] != index._heads.shape[1:]:
+            # Saved with a different embedding size; start over
+            return index
+
+        index.paths = paths
+        index.identities = identities
+        index.tails = [np.asarray(t, dtype=np.float32) for t in tails]
+        index._path_index = {p: i for i, p in enumerate(paths)}
+        index._offsets = offsets
+        index._reserve(len(heads))
+        index._heads[:len(heads)] = heads
+        index._head_norms[:len(heads)] = np.einsum("ij,ij->i", heads, heads)
+        index._head_times[:len(heads)] = head_times
+        index._rows = len(heads)
+        return index
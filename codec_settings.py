@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+
+import cv2
+
+# Where tuned settings are persisted between sessions
+SETTINGS_DIR = os.path.join(os.path.expanduser("~"), ".vidstitch")
+SETTINGS_PATH = os.path.join(SETTINGS_DIR, "codec_settings.json")
+
+# OpenCV reads its FFmpeg options from a process-wide environment variable, so opens
+# that set it must not overlap between threads
+_capture_env_lock = threading.Lock()
+
+
+class CodecSettings:
+    """
+    Decoder/encoder configuration shared by thumbnailing, analysis, preview and export.
+
+    A thread count of 0 means "use every core" and is resolved against the host.
+    When auto_tune is on, the decoder threading is benchmarked once on a sample
+    clip and the winner is persisted to SETTINGS_PATH.
+    """
+
+    THREAD_TYPES = ("frame", "slice")
+
+    def __init__(self, decoder_threads=0, thread_type="frame", encoder_threads=0,
+                 preset="medium", crf=23, pixel_format="yuv420p", auto_tune=True):
+        if thread_type not in self.THREAD_TYPES:
+            raise ValueError(f"thread_type must be one of {self.THREAD_TYPES}, got {thread_type!r}")
+        self.decoder_threads = decoder_threads
+        self.thread_type = thread_type
+        self.encoder_threads = encoder_threads
+        self.preset = preset
+        self.crf = crf
+        self.pixel_format = pixel_format
+        self.auto_tune = auto_tune
+        self.tuned_cpu_count = None  # host core count the tuned values were measured on
+
+    @property
+    def is_tuned(self):
+        return self.tuned_cpu_count == os.cpu_count()
+
+    def resolved_decoder_threads(self):
+        return self.decoder_threads or os.cpu_count() or 1
+
+    def resolved_encoder_threads(self):
+        return self.encoder_threads or os.cpu_count() or 1
+
+    def open_capture(self, path):
+        """
+        Opens a cv2.VideoCapture on path using the configured decoder threading.
+        """
+        threads = self.resolved_decoder_threads()
+        options = f"threads;{threads}|thread_type;{self.thread_type}"
+        params = []
+        if hasattr(cv2, "CAP_PROP_N_THREADS"):
+            params = [cv2.CAP_PROP_N_THREADS, threads]
+
+        with _capture_env_lock:
+            previous = os.environ.get("OPENCV_FFMPEG_CAPTURE_OPTIONS")
+            os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = options
+            try:
+                cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG, params)
+            finally:
+                if previous is None:
+                    os.environ.pop("OPENCV_FFMPEG_CAPTURE_OPTIONS", None)
+                else:
+                    os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = previous
+
+        if not cap.isOpened():
+            # Fall back to whatever backend OpenCV picks by default
+            cap = cv2.VideoCapture(path)
+        return cap
+
+    def write_kwargs(self):
+        """
+        Returns keyword arguments for MoviePy's write_videofile.
+        """
+        return {
+            "codec": "libx264",
+            "audio_codec": "aac",
+            "preset": self.preset,
+            "threads": self.resolved_encoder_threads(),
+            "pixel_format": self.pixel_format,
+            "ffmpeg_params": ["-crf", str(self.crf)],
+        }
+
+    def to_dict(self):
+        return {
+            "decoder_threads": self.decoder_threads,
+            "thread_type": self.thread_type,
+            "encoder_threads": self.encoder_threads,
+            "preset": self.preset,
+            "crf": self.crf,
+            "pixel_format": self.pixel_format,
+            "auto_tune": self.auto_tune,
+            "tuned_cpu_count": self.tuned_cpu_count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        settings = cls(
+            decoder_threads=data.get("decoder_threads", 0),
+            thread_type=data.get("thread_type", "frame"),
+            encoder_threads=data.get("encoder_threads", 0),
+            preset=data.get("preset", "medium"),
+            crf=data.get("crf", 23),
+            pixel_format=data.get("pixel_format", "yuv420p"),
+            auto_tune=data.get("auto_tune", True),
+        )
+        settings.tuned_cpu_count = data.get("tuned_cpu_count")
+        return settings
+
+    @classmethod
+    def load(cls, path=SETTINGS_PATH):
+        """
+        Loads persisted settings, returning defaults if there are none or they can't be read.
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls.from_dict(json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+    def save(self, path=SETTINGS_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def autotune(self, sample_path, max_frames=120, path=SETTINGS_PATH):
+        """
+        Benchmarks decoder thread counts and threading modes on sample_path, keeps the
+        fastest combination and persists it. Returns the measured frames per second.
+        """
+        cores = os.cpu_count() or 1
+        thread_counts = sorted({1, 2, 4, 8, 16, cores} & set(range(1, cores + 1)))
+
+        # Benchmark on a copy; other threads may be opening captures with these settings
+        candidate = CodecSettings.from_dict(self.to_dict())
+        best = None
+        for thread_type in self.THREAD_TYPES:
+            for threads in thread_counts:
+                candidate.decoder_threads, candidate.thread_type = threads, thread_type
+                fps = candidate._benchmark_decode(sample_path, max_frames)
+                if fps and (best is None or fps > best[0]):
+                    best = (fps, threads, thread_type)
+
+        if best is None:
+            # Sample couldn't be decoded; keep what we had and try again next time
+            return 0.0
+
+        fps, threads, thread_type = best
+        # Using every core is reported as 0 so the setting follows the host
+        self.decoder_threads = 0 if threads == cores else threads
+        self.thread_type = thread_type
+        self.tuned_cpu_count = cores
+        self.save(path)
+        print(f"Decoder tuned: {threads} threads, {thread_type} threading ({fps:.1f} fps)")
+        return fps
+
+    def _benchmark_decode(self, sample_path, max_frames):
+        cap = self.open_capture(sample_path)
+        try:
+            if not cap.isOpened():
+                return 0.0
+            start = time.perf_counter()
+            frames = 0
+            while frames < max_frames and cap.grab():
+                cap.retrieve()
+                frames += 1
+            elapsed = time.perf_counter() - start
+            return frames / elapsed if frames and elapsed > 0 else 0.0
+        finally:
+            cap.release()
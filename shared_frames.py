@@ -0,0 +1,98 @@
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def attach_shared_memory(name):
+    """
+    Attaches to an existing shared-memory block created by another process.
+    The creating process owns the block; attaching processes only close it.
+    """
+    if sys.version_info >= (3, 13):
+        # Keep the resource tracker from unlinking a block this process doesn't own
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+class SharedFrameRing:
+    """
+    A fixed number of shared-memory slots that decoder workers write sampled frames
+    into and the scoring stage reads back as zero-copy NumPy views.
+
+    Slots are reused across jobs and only grown when a larger window comes along,
+    so peak memory scales with the number of slots (workers), not with the number
+    of clips. Use as a context manager so every block is unlinked when the job
+    completes or is cancelled.
+    """
+
+    def __init__(self, slots):
+        self._blocks = [None] * max(1, slots)
+        self._free = list(range(len(self._blocks)))
+
+    @property
+    def slots(self):
+        return len(self._blocks)
+
+    def has_free_slot(self):
+        return bool(self._free)
+
+    def acquire(self, nbytes):
+        """
+        Reserves a free slot of at least nbytes and returns its index.
+        Raises RuntimeError if every slot is in use.
+        """
+        if not self._free:
+            raise RuntimeError("No free frame buffer slot")
+        index = self._free.pop()
+        block = self._blocks[index]
+        if block is None or block.size < nbytes:
+            if block is not None:
+                self._free_block(block)
+            block = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+            self._blocks[index] = block
+        return index
+
+    def name(self, index):
+        """Returns the shared-memory name a worker process attaches to."""
+        return self._blocks[index].name
+
+    def view(self, index, shape, dtype=np.uint8):
+        """
+        Returns a zero-copy array over the slot.
+        Drop the view before releasing the slot; the next job overwrites the memory.
+        """
+        return np.ndarray(shape, dtype=dtype, buffer=self._blocks[index].buf)
+
+    def release(self, index):
+        """Returns the slot to the pool for the next job."""
+        if index not in self._free:
+            self._free.append(index)
+
+    def close(self):
+        """Frees every shared-memory block. Safe to call more than once."""
+        for i, block in enumerate(self._blocks):
+            if block is not None:
+                self._free_block(block)
+                self._blocks[i] = None
+        self._free = list(range(len(self._blocks)))
+
+    @staticmethod
+    def _free_block(block):
+        try:
+            block.close()
+        except BufferError:
+            # A view is still alive; unlinking below still releases the memory
+            # once that last reference goes away.
+            pass
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
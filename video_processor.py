@@ -1,14 +1,149 @@
 import os
+import hashlib
+import json
+import re
+import subprocess
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+import multiprocessing
 import numpy as np
 import cv2
-from moviepy import VideoFileClip, concatenate_videoclips
+from moviepy import AudioClip, VideoFileClip
+from moviepy.config import FFMPEG_BINARY
 from skimage.metrics import structural_similarity as ssim
 from PIL import Image
+from shared_frames import SharedFrameRing, attach_shared_memory
+from codec_settings import CodecSettings, SETTINGS_DIR
+from clip_library import ClipLibraryIndex, LIBRARY_PATH, embed_window, file_identity
+
+
+def _decode_window(path, times, out, settings):
+    """
+    Decodes the frames at `times` from `path` as RGB into the preallocated array `out`
+    using the decoder threading from `settings` (a CodecSettings).
+    Frames are read sequentially after a single seek, taking for each time the frame
+    on screen at that time (the same frame MoviePy's get_frame returns).
+    Returns a list of flags telling which frames were decoded successfully.
+    """
+    valid = [False] * len(times)
+    if len(times) == 0:
+        return valid
+
+    cap = settings.open_capture(path)
+    try:
+        if not cap.isOpened():
+            return valid
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if fps <= 0:
+            fps = 30
+        # Seek slightly early; OpenCV may land on the frame after the requested time
+        cap.set(cv2.CAP_PROP_POS_MSEC, max(0.0, float(times[0]) - 2 / fps) * 1000)
+
+        pts = float("-inf")
+        for i, t in enumerate(times):
+            # Start time of the frame showing at t, minus a tolerance for pts rounding
+            target = int(fps * t + 0.00001) / fps - 0.25 / fps
+            ok = True
+            while ok and pts < target:
+                ok = cap.grab()
+                if ok:
+                    pts = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if not ok:
+                # Handle potential errors reading end of stream
+                break
+            ret, frame = cap.retrieve()
+            if not ret:
+                continue
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            if frame.shape != out.shape[1:]:
+                frame = cv2.resize(frame, (out.shape[2], out.shape[1]))
+            out[i] = frame
+            valid[i] = True
+    finally:
+        cap.release()
+    return valid
+
+
+def _decode_window_to_shared_memory(path, times, shm_name, shape, settings):
+    """
+    Worker process entry point. Decodes the frames at `times` from `path` straight
+    into the shared-memory slot `shm_name`, laid out as an array of `shape`.
+    `settings` is a CodecSettings dict. Returns the per-frame success flags.
+    """
+    shm = attach_shared_memory(shm_name)
+    try:
+        frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        valid = _decode_window(path, times, frames, CodecSettings.from_dict(settings))
+        del frames
+    finally:
+        shm.close()
+    return valid
+
+
+# Decoder workers must not be forked from this process: background threads may hold
+# locks (e.g. the capture environment lock) that a forked child would inherit held
+_WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Finished segment files in the segment cache (see VideoStitcher._segment_path)
+_SEGMENT_NAME = re.compile(r"seg_[0-9a-f]{20}\.mp4")
+
 
 class VideoStitcher:
     def __init__(self):
         self.clips = []
         self.search_window = 2  # seconds to search at head/tail
+        self.sample_fps = 10  # frames per second sampled inside the search window
+        self.feature_height = 512  # height of the grayscale arrays used for comparison
+
+        # Region-of-interest detection thresholds (grayscale, 0-255)
+        self.roi_static_variance = 2.0  # temporal variance below this counts as static
+        self.roi_black_level = 24  # mean intensity below this counts as black
+        self.roi_max_overlay_fraction = 0.25  # above this the whole shot is static, not an overlay
+
+        # Recently used head/tail signatures and ROI masks, keyed by file path. Kept small:
+        # stitching scores transitions as signatures arrive and caches only the results.
+        self._signature_cache = OrderedDict()
+        self.signature_cache_size = 4
+
+        # Worker processes decoding head/tail windows in parallel (1 = decode in-process)
+        self.analysis_workers = os.cpu_count() or 1
+
+        # Decoder/encoder configuration used for thumbnails, analysis, preview and export
+        self.codec_settings = CodecSettings.load()
+
+        # Incremental re-stitching: rendered segments are kept here and reused when
+        # the same (clip, in point, out point, encode settings) comes up again. The directory
+        # is per user; other app instances may be reading from it at the same time.
+        self.segment_cache_dir = os.path.join(SETTINGS_DIR, "segments")
+        self.segment_cache_grace = 3600  # seconds a segment survives pruning after its last use
+        self.min_segment_duration = 0.5  # seconds of each clip kept at least between its cuts
+        self._transition_cache = {}
+        self._previous_plan = []  # segment keys of the last stitch
+
+        # Persistent index of clip head/tail embeddings for "best next clip" queries
+        self.library_path = LIBRARY_PATH
+        self._library = None  # loaded on first use
+        self._library_lock = threading.RLock()
+        self.index_batch_size = 8  # clips opened at once while indexing
+
+    def open_capture(self, video_path):
+        """
+        Opens a cv2.VideoCapture with the configured decoder threading.
+        """
+        return self.codec_settings.open_capture(video_path)
+
+    def ensure_codec_tuned(self, sample_path, progress_callback=None):
+        """
+        Benchmarks the decoder on sample_path once per host if auto-tuning is enabled
+        and no tuned settings have been persisted yet.
+        """
+        if not self.codec_settings.auto_tune or self.codec_settings.is_tuned:
+            return
+        if progress_callback:
+            progress_callback("Tuning decoder for this machine...")
+        self.codec_settings.autotune(sample_path)
 
     def get_thumbnail(self, video_path):
         """
@@ -16,7 +151,7 @@ class VideoStitcher:
         Returns a PIL Image.
         """
         try:
-            cap = cv2.VideoCapture(video_path)
+            cap = self.open_capture(video_path)
             if not cap.isOpened():
                 return None
             ret, frame = cap.read()
@@ -29,173 +164,705 @@ class VideoStitcher:
         except Exception:
             return None
 
-    def calculate_similarity(self, frame1, frame2):
+    def _frame_features(self, frame, size=None):
+        """
+        Converts an RGB frame into the grayscale uint8 array used for comparison.
+        If size (width, height) is not given, the frame is scaled to feature_height
+        preserving its aspect ratio.
+        """
+        if size is None:
+            original_h, original_w = frame.shape[:2]
+            target_width = max(1, int(self.feature_height * original_w / original_h))
+            size = (target_width, self.feature_height)
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(gray, size)
+
+    def detect_roi(self, features):
+        """
+        Detects the informative region of a clip from a stack of sampled feature frames.
+        Letterbox/pillarbox bars (dark and static edge rows/columns) and static overlays
+        such as burned-in timestamps or logos are excluded using temporal variance.
+        Returns a boolean mask, True where pixels should be compared.
+        """
+        stack = np.asarray(features, dtype=np.float32)
+        full_mask = np.ones(stack.shape[1:], dtype=bool)
+        if len(stack) < 3:
+            # Not enough samples to tell static from moving content
+            return full_mask
+
+        mean = stack.mean(axis=0)
+        static = stack.var(axis=0) < self.roi_static_variance
+
+        # Black bars: whole rows/columns at the edges that are dark and never change
+        bar = static & (mean < self.roi_black_level)
+        bar_rows = bar.mean(axis=1) > 0.98
+        bar_cols = bar.mean(axis=0) > 0.98
+
+        def _edge_run(flags):
+            # Number of consecutive True values from the start
+            run = np.argmin(flags) if not flags.all() else len(flags)
+            return int(run)
+
+        top = _edge_run(bar_rows)
+        bottom = len(bar_rows) - _edge_run(bar_rows[::-1])
+        left = _edge_run(bar_cols)
+        right = len(bar_cols) - _edge_run(bar_cols[::-1])
+        if top >= bottom or left >= right:
+            # Entire frame looks like a bar (e.g. a fade to black)
+            return full_mask
+
+        mask = np.zeros_like(full_mask)
+        mask[top:bottom, left:right] = True
+
+        # Static overlays: pixels inside the picture area that don't change while the
+        # rest of the shot does. If most of the picture is static, it's a static shot.
+        overlay = static[top:bottom, left:right]
+        if 0 < overlay.mean() <= self.roi_max_overlay_fraction:
+            # Grow overlays slightly to also drop their anti-aliased edges
+            overlay = cv2.dilate(overlay.astype(np.uint8), np.ones((5, 5), np.uint8)).astype(bool)
+            mask[top:bottom, left:right] &= ~overlay
+
+        if not mask.any():
+            return full_mask
+        return mask
+
+    def _sample_times(self, duration):
+        """
+        Returns (head_times, tail_times) sampled at sample_fps inside the search window.
+        """
+        search_dur = min(self.search_window, duration)
+
+        # Avoid exact end of clip to prevent "bytes wanted but 0 bytes read" warning
+        safe_duration = max(0, duration - 0.01)
+        tail_start = max(0, safe_duration - search_dur)
+
+        head_times = np.linspace(0, search_dur, int(search_dur * self.sample_fps))
+        tail_times = np.linspace(tail_start, safe_duration, int(search_dur * self.sample_fps))
+        return head_times, tail_times
+
+    def get_clip_signature(self, clip):
+        """
+        Returns the cached head/tail signature of a clip, computing it on first use.
+        The signature is a dict with the sampled times and feature arrays of the head
+        and tail windows plus the ROI mask detected over both windows.
+        """
+        cache_key = self._signature_key(clip)
+        if cache_key is not None and cache_key in self._signature_cache:
+            self._signature_cache.move_to_end(cache_key)
+            return self._signature_cache[cache_key]
+
+        signature = self._compute_signature(clip)
+        if cache_key is not None:
+            self._signature_cache[cache_key] = signature
+            while len(self._signature_cache) > self.signature_cache_size:
+                self._signature_cache.popitem(last=False)
+        return signature
+
+    def _compute_signature(self, clip):
+        """
+        Decodes and builds the signature of a clip in-process, without caching it.
+        """
+        head_times, tail_times = self._sample_times(clip.duration)
+
+        path = getattr(clip, "filename", None)
+        if path is not None:
+            head = self._decode_features(path, head_times, clip.size)
+            tail = self._decode_features(path, tail_times, clip.size)
+        else:
+            head = [(t, self._frame_features(clip.get_frame(t))) for t in head_times]
+            tail = []
+            for t in tail_times:
+                try:
+                    tail.append((t, self._frame_features(clip.get_frame(t))))
+                except Exception:
+                    # Handle potential errors reading end of stream
+                    continue
+
+        return self._build_signature(head, tail)
+
+    def _decode_features(self, path, times, size):
+        """
+        Decodes the frames at times in-process and returns a list of (t, features).
+        """
+        width, height = size
+        frames = np.empty((len(times), height, width, 3), dtype=np.uint8)
+        valid = _decode_window(path, times, frames, self.codec_settings)
+        return [(t, self._frame_features(frames[i])) for i, t in enumerate(times) if valid[i]]
+
+    def _signature_key(self, clip):
+        """
+        Returns the signature cache key of a clip, or None if it isn't backed by a file.
+        The file's size and modification time are part of the key, so signatures and
+        transitions are recomputed when a clip is re-exported under the same name, and
+        so are the sampling and ROI settings, so changing them takes effect immediately.
+        """
+        path = getattr(clip, "filename", None)
+        if path is None:
+            return None
+        identity = file_identity(path)
+        if identity is None:
+            return None
+        return (
+            path, *identity,
+            self.search_window, self.sample_fps, self.feature_height,
+            self.roi_static_variance, self.roi_black_level, self.roi_max_overlay_fraction,
+        )
+
+    def _iter_signatures(self, clips, progress_callback=None, cancel_event=None):
+        """
+        Yields (clip, signature) for each distinct file-backed clip, in completion order,
+        decoding the sampled windows in parallel worker processes.
+        Workers write frames into a SharedFrameRing with one slot per worker and the
+        features are computed here from zero-copy views, so frames are never pickled.
+        Signatures are not cached; the caller decides how long to keep each one.
+        Stops early if cancel_event is set.
+        """
+        pending = []
+        seen = set()
+        for clip in clips:
+            key = self._signature_key(clip)
+            if key is not None and key not in seen:
+                seen.add(key)
+                pending.append(clip)
+
+        workers = min(self.analysis_workers, 2 * len(pending))
+        if workers <= 1:
+            for i, clip in enumerate(pending):
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                if progress_callback:
+                    progress_callback(f"Analyzing clips {i+1}/{len(pending)}...")
+                yield clip, self._compute_signature(clip)
+            return
+
+        # Split the decoder threads between workers instead of oversubscribing the host
+        worker_settings = self.codec_settings.to_dict()
+        worker_settings["decoder_threads"] = max(1, self.codec_settings.resolved_decoder_threads() // workers)
+
+        # One job per (clip, window); each job fills one ring slot
+        jobs = []
+        for clip in pending:
+            head_times, tail_times = self._sample_times(clip.duration)
+            width, height = clip.size
+            for window, times in (("head", head_times), ("tail", tail_times)):
+                jobs.append((clip, window, times, (len(times), height, width, 3)))
+
+        windows = {id(clip): {} for clip in pending}
+        total = len(jobs)
+        done = 0
+
+        context = multiprocessing.get_context(_WORKER_START_METHOD)
+        with SharedFrameRing(workers) as ring:
+            pool = context.Pool(processes=workers)
+            in_flight = {}
+            next_job = 0
+            completed = False
+            try:
+                while next_job < total or in_flight:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+
+                    while next_job < total and ring.has_free_slot():
+                        clip, window, times, shape = jobs[next_job]
+                        slot = ring.acquire(int(np.prod(shape)))
+                        result = pool.apply_async(
+                            _decode_window_to_shared_memory,
+                            (clip.filename, times, ring.name(slot), shape, worker_settings),
+                        )
+                        in_flight[result] = (slot, jobs[next_job])
+                        next_job += 1
+
+                    finished = [result for result in in_flight if result.ready()]
+                    if not finished:
+                        # Wait on the oldest job briefly, then re-check cancellation
+                        next(iter(in_flight)).wait(0.1)
+                        continue
+
+                    for result in finished:
+                        slot, (clip, window, times, shape) = in_flight.pop(result)
+                        try:
+                            valid = result.get()
+                            frames = ring.view(slot, shape)
+                            windows[id(clip)][window] = [
+                                (t, self._frame_features(frames[i]))
+                                for i, t in enumerate(times) if valid[i]
+                            ]
+                            del frames
+                        finally:
+                            ring.release(slot)
+
+                        done += 1
+                        if progress_callback:
+                            progress_callback(f"Analyzing clips {done}/{total}...")
+
+                        if len(windows[id(clip)]) == 2:
+                            parts = windows.pop(id(clip))
+                            yield clip, self._build_signature(parts["head"], parts["tail"])
+                completed = True
+            finally:
+                if completed:
+                    pool.close()
+                else:
+                    # Cancelled, failed or the consumer stopped iterating early: kill the
+                    # workers so none can block us or write into blocks about to be unlinked
+                    pool.terminate()
+                pool.join()
+
+    def analyze_transitions(self, clips, progress_callback=None, cancel_event=None):
+        """
+        Scores the transition between every pair of consecutive clips that isn't cached
+        yet, decoding only the clips those pairs involve.
+        Each pair is scored as soon as both signatures have arrived and a signature is
+        dropped once all of its pairs are done, so only the signatures of clips still in
+        flight are held at a time. Jobs are submitted in sequence order, which keeps
+        that set bounded by the number of workers rather than the number of clips.
+        Returns False if cancel_event was set before all transitions were analyzed.
+        """
+        pairs = {}  # (key_a, key_b) -> duration of clip a
+        for clip_a, clip_b in zip(clips, clips[1:]):
+            pair_key = (self._signature_key(clip_a), self._signature_key(clip_b))
+            if None not in pair_key and pair_key not in self._transition_cache:
+                pairs[pair_key] = clip_a.duration
+        if not pairs:
+            return True
+
+        needed = {key for pair in pairs for key in pair}
+        remaining = {key: sum(key in pair for pair in pairs) for key in needed}
+        to_decode = [clip for clip in clips if self._signature_key(clip) in needed]
+
+        live = {}
+        for clip, signature in self._iter_signatures(to_decode, progress_callback, cancel_event):
+            live[self._signature_key(clip)] = signature
+            for pair_key in [pair for pair in pairs if pair[0] in live and pair[1] in live]:
+                self._transition_cache[pair_key] = self._best_transition_from_signatures(
+                    live[pair_key[0]], live[pair_key[1]], pairs.pop(pair_key)
+                )
+                for key in set(pair_key):
+                    remaining[key] -= 1
+                    if remaining[key] <= 0:
+                        live.pop(key, None)
+
+        return not pairs
+
+    def _build_signature(self, head, tail):
+        """
+        Assembles a signature dict from lists of (t, features) for the head and tail windows.
+        The feature stacks are cropped to the bounding box of the detected ROI and kept
+        as uint8; "box" is that crop (y0, y1, x0, x1) within the full feature frame of
+        "size" (width, height), and "roi" is the mask inside the crop (None = all pixels).
+        """
+        head_frames = np.array([f for _, f in head], dtype=np.uint8)
+        tail_frames = np.array([f for _, f in tail], dtype=np.uint8)
+        signature = {
+            "head_times": np.array([t for t, _ in head]),
+            "tail_times": np.array([t for t, _ in tail]),
+            "roi": None,
+        }
+
+        windows = [w for w in (head_frames, tail_frames) if len(w)]
+        if not windows:
+            signature.update(head=head_frames, tail=tail_frames, box=(0, 0, 0, 0), size=(0, 0))
+            return signature
+
+        h, w = windows[0].shape[1:]
+        roi = self.detect_roi(np.concatenate(windows))
+        rows = np.flatnonzero(roi.any(axis=1))
+        cols = np.flatnonzero(roi.any(axis=0))
+        y0, y1, x0, x1 = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+        roi = roi[y0:y1, x0:x1]
+
+        signature.update(
+            head=np.ascontiguousarray(head_frames[:, y0:y1, x0:x1]) if len(head_frames) else head_frames,
+            tail=np.ascontiguousarray(tail_frames[:, y0:y1, x0:x1]) if len(tail_frames) else tail_frames,
+            roi=None if roi.all() else roi,
+            box=(y0, y1, x0, x1),
+            size=(w, h),
+        )
+        return signature
+
+    def _pair_region(self, sig1, sig2):
         """
-        Calculates similarity between two frames using MSE on resized grayscale images.
-        Lower score means more similar.
+        Returns (tail1, head2, mask) as float32 arrays covering the region both clips
+        consider informative, in clip1's feature coordinates. head2 is rescaled if the
+        clips differ in size or aspect ratio. mask is None when every pixel is compared.
         """
-        # Get original aspect ratio from one of the frames
-        original_h, original_w, _ = frame1.shape
-        original_aspect = original_w / original_h
+        tail1 = sig1["tail"]
+        head2 = sig2["head"]
+        if len(tail1) == 0 or len(head2) == 0:
+            return tail1.astype(np.float32), head2.astype(np.float32), None
+
+        (w1, h1), (w2, h2) = sig1["size"], sig2["size"]
+        sx, sy = w1 / w2, h1 / h2
+        a_y0, a_y1, a_x0, a_x1 = sig1["box"]
+        b_y0, b_y1, b_x0, b_x1 = sig2["box"]
 
-        # Define target height for comparison (e.g., 128 pixels)
-        target_height = 512
-        target_width = int(target_height * original_aspect)
-        
-        # Ensure target_width is at least 1 pixel to avoid errors with very thin videos
-        target_width = max(1, target_width)
+        # Intersection of both crops, in clip1 coordinates
+        y0 = max(a_y0, int(round(b_y0 * sy)))
+        y1 = min(a_y1, int(round(b_y1 * sy)))
+        x0 = max(a_x0, int(round(b_x0 * sx)))
+        x1 = min(a_x1, int(round(b_x1 * sx)))
+        if y0 >= y1 or x0 >= x1:
+            # The informative regions don't overlap; compare clip1's region as a whole
+            y0, y1, x0, x1 = a_y0, a_y1, a_x0, a_x1
 
-        # Resize frames preserving aspect ratio
-        img1 = cv2.resize(cv2.cvtColor(frame1, cv2.COLOR_RGB2GRAY), (target_width, target_height))
-        img2 = cv2.resize(cv2.cvtColor(frame2, cv2.COLOR_RGB2GRAY), (target_width, target_height))
-        
-        mse = np.mean((img1 - img2) ** 2)
-        return mse
+        roi1 = sig1["roi"] if sig1["roi"] is not None else np.ones((a_y1 - a_y0, a_x1 - a_x0), dtype=bool)
+        roi2 = sig2["roi"] if sig2["roi"] is not None else np.ones((b_y1 - b_y0, b_x1 - b_x0), dtype=bool)
+
+        tail1 = tail1[:, y0 - a_y0:y1 - a_y0, x0 - a_x0:x1 - a_x0]
+        mask1 = roi1[y0 - a_y0:y1 - a_y0, x0 - a_x0:x1 - a_x0]
+
+        # Same region in clip2 coordinates, clamped to clip2's crop
+        c_y0 = min(max(int(np.floor(y0 / sy)), b_y0), b_y1 - 1) - b_y0
+        c_y1 = max(min(int(np.ceil(y1 / sy)), b_y1), b_y0 + c_y0 + 1) - b_y0
+        c_x0 = min(max(int(np.floor(x0 / sx)), b_x0), b_x1 - 1) - b_x0
+        c_x1 = max(min(int(np.ceil(x1 / sx)), b_x1), b_x0 + c_x0 + 1) - b_x0
+        head2 = head2[:, c_y0:c_y1, c_x0:c_x1]
+        mask2 = roi2[c_y0:c_y1, c_x0:c_x1]
+        if head2.shape[1:] != tail1.shape[1:]:
+            size = (tail1.shape[2], tail1.shape[1])
+            head2 = np.array([cv2.resize(f, size) for f in head2])
+            mask2 = cv2.resize(mask2.astype(np.uint8), size, interpolation=cv2.INTER_NEAREST).astype(bool)
+
+        mask = mask1 & mask2
+        if not mask.any() or mask.all():
+            mask = None
+        # float32 only for the difference math
+        return tail1.astype(np.float32), head2.astype(np.float32), mask
 
     def find_best_transition(self, clip1, clip2):
         """
         Finds the timestamp in clip1 (end) and clip2 (start) that minimizes the difference.
+        Only the region of interest shared by both clips is compared.
+        Results are cached per clip pair, so re-stitching after an edit only analyzes
+        the transitions that changed.
         Returns (t1, t2) where t1 is cut point for clip1, t2 is start point for clip2.
         """
-        # Determine search duration based on clip lengths
-        duration1 = clip1.duration
-        duration2 = clip2.duration
-        
-        search_dur1 = min(self.search_window, duration1)
-        search_dur2 = min(self.search_window, duration2)
-        
-        # Extract frames at roughly 10 fps for the search window to save time
-        # We don't need to check every single frame for a rough match, but let's try 
-        # to be somewhat precise.
-        fps_check = 10
-        
-        # Times to check
-        t1_start = duration1 - search_dur1
-        t2_end = search_dur2
-        
-        # Generate frames
-        # iter_frames yields (t, frame) ideally, but moviepy yields just frame
-        # We'll generate times manually
-        # Avoid exact end of clip to prevent "bytes wanted but 0 bytes read" warning
-        safe_duration1 = max(0, duration1 - 0.01)
-        t1_start = max(0, safe_duration1 - search_dur1)
-        
-        times1 = np.linspace(t1_start, safe_duration1, int(search_dur1 * fps_check))
-        times2 = np.linspace(0, t2_end, int(search_dur2 * fps_check))
-        
+        pair_key = (self._signature_key(clip1), self._signature_key(clip2))
+        if None not in pair_key and pair_key in self._transition_cache:
+            return self._transition_cache[pair_key]
+
+        sig1 = self.get_clip_signature(clip1)
+        sig2 = self.get_clip_signature(clip2)
+        result = self._best_transition_from_signatures(sig1, sig2, clip1.duration)
+        if None not in pair_key:
+            self._transition_cache[pair_key] = result
+        return result
+
+    def _best_transition_from_signatures(self, sig1, sig2, duration1, min_t1=None):
+        """
+        Scores every tail frame of sig1 against every head frame of sig2.
+        If min_t1 is given, only tail frames at or after it are considered, and None is
+        returned when there are none.
+        Returns (t1, t2) of the most similar pair.
+        """
         best_score = float('inf')
-        best_t1 = safe_duration1
+        best_t1 = max(0, duration1 - 0.01)
         best_t2 = 0
-        
-        # Cache frames for clip2 to avoid re-reading
-        frames2 = [(t, clip2.get_frame(t)) for t in times2]
-        
-        for t1 in times1:
-            try:
-                frame1 = clip1.get_frame(t1)
-                for t2, frame2 in frames2:
-                    score = self.calculate_similarity(frame1, frame2)
-                    if score < best_score:
-                        best_score = score
-                        best_t1 = t1
-                        best_t2 = t2
-            except Exception as e:
-                # Handle potential errors reading end of stream
-                continue
-                
+
+        tail1, head2, mask = self._pair_region(sig1, sig2)
+        tail_times = sig1["tail_times"]
+        if min_t1 is not None:
+            allowed = tail_times >= min_t1
+            if not allowed.any():
+                return None
+            tail1, tail_times = tail1[allowed], tail_times[allowed]
+
+        if len(tail1) and len(head2):
+            # Flatten to (frames, pixels) restricted to the mask
+            if mask is not None:
+                vec1 = tail1[:, mask]
+                vec2 = head2[:, mask]
+            else:
+                vec1 = tail1.reshape(len(tail1), -1)
+                vec2 = head2.reshape(len(head2), -1)
+
+            for i, v1 in enumerate(vec1):
+                scores = np.mean((vec2 - v1) ** 2, axis=1)
+                j = int(np.argmin(scores))
+                if scores[j] < best_score:
+                    best_score = float(scores[j])
+                    best_t1 = float(tail_times[i])
+                    best_t2 = float(sig2["head_times"][j])
+
         print(f"Best transition found: Cut Clip A at {best_t1:.2f}s, Start Clip B at {best_t2:.2f}s (Score: {best_score:.2f})")
         return best_t1, best_t2
 
-    def stitch_videos(self, video_paths, output_path, progress_callback=None):
+    @property
+    def library(self):
+        """The clip library index, loaded from library_path on first use."""
+        with self._library_lock:
+            if self._library is None:
+                self._library = ClipLibraryIndex.load(self.library_path)
+            return self._library
+
+    def is_indexed(self, video_path):
+        """Returns True if video_path is in the library and unchanged since it was indexed."""
+        with self._library_lock:
+            return self.library.is_current(video_path)
+
+    def index_clips(self, video_paths, progress_callback=None):
+        """
+        Adds clips to the library index, skipping those already indexed and unchanged.
+        Clips are processed in batches of index_batch_size: each batch is opened,
+        analyzed in parallel like when stitching, embedded and closed before the next,
+        and the index is saved after every batch. Only the compact embeddings are kept.
+        Returns the number of clips added.
+        """
+        library = self.library
+        with self._library_lock:
+            pending = [p for p in dict.fromkeys(video_paths) if not library.is_current(p)]
+        # Taken before decoding, so a file rewritten mid-analysis is picked up next time
+        identities = {path: file_identity(path) for path in pending}
+
+        added = 0
+        for batch_start in range(0, len(pending), self.index_batch_size):
+            batch = pending[batch_start:batch_start + self.index_batch_size]
+            if progress_callback:
+                progress_callback(f"Indexing clips {batch_start+1}-{batch_start+len(batch)}/{len(pending)}...")
+
+            loaded_clips = []
+            try:
+                for path in batch:
+                    try:
+                        loaded_clips.append(VideoFileClip(path, audio=False))
+                    except Exception as e:
+                        print(f"Skipping {path} for library index: {e}")
+
+                # Signatures are embedded as they arrive and not kept afterwards
+                for clip, signature in self._iter_signatures(loaded_clips):
+                    heads = embed_window(signature["head"], signature["roi"])
+                    tails = embed_window(signature["tail"], signature["roi"])
+                    with self._library_lock:
+                        library.add(clip.filename, heads, signature["head_times"], tails,
+                                    identity=identities.get(clip.filename))
+                    added += 1
+            finally:
+                for clip in loaded_clips:
+                    clip.close()
+
+            with self._library_lock:
+                library.save(self.library_path)
+        return added
+
+    def suggest_next_clips(self, video_path, k=5, exclude=()):
+        """
+        Returns up to k (path, score, start_time) tuples from the library for clips that
+        flow best after video_path, best first. Lower scores are smoother transitions.
+        video_path is indexed first if needed.
+        """
+        if not self.is_indexed(video_path):
+            self.index_clips([video_path])
+        with self._library_lock:
+            return self.library.query_path(video_path, k=k, exclude=exclude)
+
+    def plan_segments(self, clips, progress_callback=None):
+        """
+        Chains the best transitions between consecutive clips.
+        Returns a list of (clip_index, t_in, t_out), one segment per clip:
+        Clip 1: 0 -> cut_1, Clip 2: start_2 -> cut_2, ..., Clip N: start_N -> end
+        """
+        plan = []
+        # Greedy approach: optimize 1-2, then 2-3, etc., carrying each clip's start
+        current_clip_start_time = 0
+        for i in range(len(clips) - 1):
+            if progress_callback:
+                progress_callback(f"Stitching {i+1} & {i+2}...")
+            clip_a = clips[i]
+            cut_a, start_b = self.find_best_transition(clip_a, clips[i+1])
+
+            # In clips shorter than twice the search window the head and tail windows
+            # overlap, so the best cut can land before (or right after) the start point.
+            # Search only the part of the tail after the start instead.
+            min_cut = current_clip_start_time + self.min_segment_duration
+            if cut_a < min_cut:
+                sig_a = self.get_clip_signature(clip_a)
+                sig_b = self.get_clip_signature(clips[i+1])
+                constrained = self._best_transition_from_signatures(sig_a, sig_b, clip_a.duration, min_t1=min_cut)
+                if constrained is not None:
+                    cut_a, start_b = constrained
+                else:
+                    cut_a = min(clip_a.duration, min_cut)
+                    if progress_callback:
+                        progress_callback(f"Clip {i+1} is too short for a smart cut, keeping {cut_a - current_clip_start_time:.2f}s of it")
+
+            if cut_a > current_clip_start_time:
+                plan.append((i, current_clip_start_time, cut_a))
+            elif progress_callback:
+                progress_callback(f"Clip {i+1} has no footage left after trimming and was skipped")
+            current_clip_start_time = start_b
+
+        last_clip = clips[-1]
+        plan.append((len(clips) - 1, current_clip_start_time, last_clip.duration))
+        return plan
+
+    def _segment_key(self, clip, t_in, t_out, output_format):
+        """
+        Returns a stable key for a rendered segment. Any change to the source file, the
+        in/out points, the output geometry or the encode settings gives a new key.
+        """
+        path = clip.filename
+        stat = os.stat(path)
+        settings = self.codec_settings
+        payload = {
+            "source": [os.path.abspath(path), stat.st_size, stat.st_mtime_ns],
+            "in": round(float(t_in), 3),
+            "out": round(float(t_out), 3),
+            "format": output_format,
+            "encode": [settings.preset, settings.crf, settings.pixel_format],
+        }
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+
+    def _segment_path(self, key):
+        return os.path.join(self.segment_cache_dir, f"seg_{key}.mp4")
+
+    def _render_segment(self, clip, t_in, t_out, output_format, segment_path):
+        """
+        Encodes clip[t_in:t_out] into segment_path so that all segments share the same
+        resolution, frame rate and stream layout and can be joined by stream copy.
+        """
+        size, fps, with_audio = output_format
+        segment = clip.subclipped(t_in, t_out)
+        if tuple(segment.size) != tuple(size):
+            # Same letterboxing concatenate_videoclips(method="compose") would apply
+            segment = segment.with_background_color(size=tuple(size), color=(0, 0, 0), pos="center")
+        if with_audio and segment.audio is None:
+            # Stereo silence, matching the two channels MoviePy decodes real audio to
+            silence = AudioClip(
+                lambda t: np.zeros((len(t), 2)) if isinstance(t, np.ndarray) else np.zeros(2),
+                duration=segment.duration,
+                fps=44100,
+            )
+            segment = segment.with_audio(silence)
+
+        # Render under a temporary name so a cancelled render never leaves a bad cache entry
+        # (unique per process and thread, in case another instance renders the same segment)
+        partial_stem = segment_path[:-len(".mp4")] + f".{os.getpid()}-{threading.get_ident()}"
+        partial_path = partial_stem + ".part.mp4"
+        partial_audio_path = partial_stem + ".part-audio.m4a"
+        try:
+            segment.write_videofile(
+                partial_path, fps=fps, audio=with_audio, audio_fps=44100,
+                temp_audiofile=partial_audio_path, logger=None, **self.codec_settings.write_kwargs()
+            )
+            os.replace(partial_path, segment_path)
+        except BaseException:
+            # Pruning never touches temporary names, so clean them up here
+            for path in (partial_path, partial_audio_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+
+    def _concat_segments(self, segment_paths, output_path):
+        """
+        Joins rendered segments with ffmpeg's concat demuxer without re-encoding.
+        """
+        fd, list_path = tempfile.mkstemp(prefix="concat_", suffix=".txt", dir=self.segment_cache_dir)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for path in segment_paths:
+                    escaped = path.replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            subprocess.run(
+                [FFMPEG_BINARY, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                 "-i", list_path, "-c", "copy", "-movflags", "+faststart", output_path],
+                check=True,
+            )
+        finally:
+            os.remove(list_path)
+
+    def _touch_segments(self, keys):
+        """
+        Marks segments as recently used so pruning in other instances leaves them alone.
+        """
+        for key in keys:
+            try:
+                os.utime(self._segment_path(key))
+            except OSError:
+                pass
+
+    def _prune_segment_cache(self, keep_keys):
+        """
+        Deletes finished segments that belong neither to the current nor the previous plan
+        and haven't been used for segment_cache_grace seconds. In-progress renders and
+        other temporary files are never touched.
+        """
+        keep = {os.path.basename(self._segment_path(key)) for key in keep_keys}
+        cutoff = time.time() - self.segment_cache_grace
+        for name in os.listdir(self.segment_cache_dir):
+            if not _SEGMENT_NAME.fullmatch(name) or name in keep:
+                continue
+            path = os.path.join(self.segment_cache_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stitch_videos(self, video_paths, output_path, progress_callback=None, cancel_event=None):
+        """
+        Stitches the videos at the smartest cut points and writes the result to output_path.
+        Each clip's segment is rendered to its own cached file and the segments are
+        joined by stream copy, so after an edit only segments whose clip, in/out points
+        or encode settings changed are re-encoded.
+        If cancel_event (a threading.Event) is set, stops early and frees all decoding
+        buffers without writing output.
+        """
         if not video_paths:
             return
 
         loaded_clips = []
         try:
+            self.ensure_codec_tuned(video_paths[0], progress_callback)
+
             # 1. Load all clips
             for i, path in enumerate(video_paths):
                 if progress_callback:
                     progress_callback(f"Loading video {i+1}/{len(video_paths)}...")
                 loaded_clips.append(VideoFileClip(path))
 
-            if len(loaded_clips) < 2:
-                # Just export the single clip
-                 if progress_callback:
-                    progress_callback("Exporting single video...")
-                 loaded_clips[0].write_videofile(output_path, codec="libx264", audio_codec="aac")
-                 return
-
-            final_subclips = []
-            
-            # 2. Process pairs
-            # First clip is always kept from start
-            prev_clip = loaded_clips[0]
-            
-            for i in range(1, len(loaded_clips)):
-                next_clip = loaded_clips[i]
-                
+            # 2. Decode and analyze the transitions that aren't cached, in parallel
+            if not self.analyze_transitions(loaded_clips, progress_callback, cancel_event):
                 if progress_callback:
-                    progress_callback(f"Analyzing transition {i}/{len(loaded_clips)-1}...")
-                
-                # Find best cut points
-                cut_prev, start_next = self.find_best_transition(prev_clip, next_clip)
-                
-                # Trim previous clip
-                # Note: If this is the first iteration, we take from 0. 
-                # If it's not, we've effectively already "consumed" the previous clip, 
-                # but wait -- we need to handle the chain.
-                # Chain strategy:
-                # Clip 1: 0 -> cut_1
-                # Clip 2: start_2 -> cut_2
-                # ...
-                # Clip N: start_N -> end
-                
-                # For the current pair (prev_clip, next_clip):
-                # We determine where prev_clip ENDS and where next_clip STARTS.
-                
-                # For the very first clip, we start at 0.
-                # For subsequent clips, the 'start' was determined in the previous iteration.
-                # BUT, determining the "end" of Clip 2 might depend on Clip 3.
-                # This implies a greedy approach: optimize 1-2, then 2-3, etc.
-                # So we need to store "start_point" for the current clip (determined by previous transition)
-                
-                pass 
-
-            # Refined Logic for Chaining
-            # We need to track "start_time" for the current clip.
-            current_clip_start_time = 0
-            
-            trimmed_clips = []
-            
-            for i in range(len(loaded_clips) - 1):
-                clip_a = loaded_clips[i]
-                clip_b = loaded_clips[i+1]
-                
+                    progress_callback("Cancelled")
+                return
+
+            # 3. Plan the cuts and diff against the previous stitch
+            plan = self.plan_segments(loaded_clips, progress_callback)
+
+            # Common output format, matching what concatenate_videoclips(method="compose") produced
+            output_size = [max(c.size[0] for c in loaded_clips), max(c.size[1] for c in loaded_clips)]
+            output_fps = max(c.fps for c in loaded_clips)
+            with_audio = any(c.audio is not None for c in loaded_clips)
+            output_format = [output_size, output_fps, with_audio]
+
+            # Keys are content-addressed, so a segment shared with the previous plan (or
+            # left over from an earlier session) is reused as long as its file exists
+            keys = [self._segment_key(loaded_clips[i], t_in, t_out, output_format) for i, t_in, t_out in plan]
+            os.makedirs(self.segment_cache_dir, exist_ok=True)
+            changed = [n for n, key in enumerate(keys) if not os.path.exists(self._segment_path(key))]
+
+            # 4. Re-encode only the changed segments
+            for done, n in enumerate(changed):
+                if cancel_event is not None and cancel_event.is_set():
+                    if progress_callback:
+                        progress_callback("Cancelled")
+                    return
                 if progress_callback:
-                    progress_callback(f"Stitching {i+1} & {i+2}...")
-
-                cut_a, start_b = self.find_best_transition(clip_a, clip_b)
-                
-                # Add the segment of Clip A
-                segment = clip_a.subclipped(current_clip_start_time, cut_a)
-                trimmed_clips.append(segment)
-                
-                # Update start time for Clip B for the next iteration
-                current_clip_start_time = start_b
-                
-            # Add the final clip remainder
-            last_clip = loaded_clips[-1]
-            segment = last_clip.subclipped(current_clip_start_time, last_clip.duration)
-            trimmed_clips.append(segment)
-
-            # 3. Concatenate
+                    progress_callback(f"Rendering segment {done+1}/{len(changed)} ({len(plan) - len(changed)} reused)...")
+                i, t_in, t_out = plan[n]
+                self._render_segment(loaded_clips[i], t_in, t_out, output_format, self._segment_path(keys[n]))
+
+            # 5. Join everything without re-encoding
             if progress_callback:
                 progress_callback("Rendering final video...")
-                
-            final_clip = concatenate_videoclips(trimmed_clips, method="compose")
-            final_clip.write_videofile(output_path, codec="libx264", audio_codec="aac", logger=None)
-            final_clip.close()
-            
+            self._touch_segments(keys)
+            self._concat_segments([self._segment_path(key) for key in keys], output_path)
+
+            self._prune_segment_cache(set(keys) | set(self._previous_plan))
+            self._previous_plan = keys
+
             if progress_callback:
                 progress_callback("Done!")
 